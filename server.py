@@ -18,18 +18,26 @@ Outputs:
 
 import io
 import os
+import asyncio
 import json
+import re
 import uuid
-import base64
+import hashlib
+import functools
 import logging
 import sys
 import textwrap
+import threading
+from collections import OrderedDict
 
+import orjson
+import pybase64
 from mcp.server.fastmcp import FastMCP
 from pypdf import PdfReader, PdfWriter
 from pypdf.generic import BooleanObject, NameObject
 import google.generativeai as genai
 from pdf2image import convert_from_bytes # For vision capability
+from PIL import Image
 
 # ----- Configuration ----------------------------------------------------
 
@@ -46,6 +54,24 @@ except Exception as e:
 # Switched to Flash model for speed and to avoid rate limits.
 LLM_MODEL = "gemini-1.5-flash-latest" 
 
+# Page renders are sent to the vision model, which downsamples large images
+# itself, so there is no point rendering or uploading more pixels than this.
+VISION_DPI = 100
+VISION_MAX_SIDE = 1024
+
+# Forms with more fields than this are split into concurrent extraction calls.
+EXTRACTION_CHUNK_THRESHOLD = 50
+EXTRACTION_CHUNK_SIZE = 25
+# Caps in-flight extraction calls across all requests, to stay under the
+# Gemini rate limit; a 429 would otherwise come back as all-"N/A" answers.
+EXTRACTION_MAX_CONCURRENCY = 4
+
+_extraction_slots = asyncio.Semaphore(EXTRACTION_MAX_CONCURRENCY)
+
+# The outermost JSON object in an LLM reply, skipping any markdown code
+# fences or stray prose the model wraps around it.
+_JSON_RE = re.compile(r"\{.*\}", re.S)
+
 log = logging.getLogger("smart-pdf-fill")
 logging.basicConfig(
     stream=sys.stderr,
@@ -53,45 +79,195 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
+# ----- Template Caches --------------------------------------------------
+
+# A clarifying question sends the user back to call fill_form again on the
+# same blank PDF, so per-template work is cached by content digest.
+TEMPLATE_CACHE_SIZE = 32
+
+_page_images: OrderedDict[str, bytes] = OrderedDict()
+# PdfReader resolves objects lazily from a shared stream, so each cached
+# reader is paired with a lock that guards every use of it.
+_readers: OrderedDict[str, tuple[PdfReader, threading.Lock]] = OrderedDict()
+_filled_pdfs: OrderedDict[str, bytes] = OrderedDict()
+_field_mappings: OrderedDict[str, dict[str, str]] = OrderedDict()
+
+# The caches are read and written from asyncio.to_thread workers, so every
+# lookup and eviction happens under this lock.
+_cache_lock = threading.Lock()
+
+
+def pdf_digest(pdf_bytes: bytes) -> str:
+    """Returns a short content digest used to key the template caches."""
+    return hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+
+def _cache_get(cache: OrderedDict, key: str):
+    """Looks up a key in a bounded LRU cache, marking it as recently used."""
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache: OrderedDict, key: str, value) -> None:
+    """Stores a value in a bounded LRU cache, evicting the oldest entry."""
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > TEMPLATE_CACHE_SIZE:
+            cache.popitem(last=False)
+
 # ----- PDF Helper Function ----------------------------------------------
 
-def fill_pdf_bytes(pdf_bytes: bytes, values: dict[str, str]) -> bytes:
+def get_reader(pdf_bytes: bytes, digest: str) -> tuple[PdfReader, threading.Lock]:
+    """Returns the parsed PDF and its lock, reusing a cached reader for the same document."""
+    entry = _cache_get(_readers, digest)
+    if entry is None:
+        entry = (PdfReader(io.BytesIO(pdf_bytes)), threading.Lock())
+        _cache_put(_readers, digest, entry)
+    return entry
+
+
+def read_form_fields(pdf_bytes: bytes, digest: str) -> dict:
+    """Returns all form fields of the PDF, keyed by their qualified name."""
+    reader, lock = get_reader(pdf_bytes, digest)
+    with lock:
+        return reader.get_fields() or {}
+
+
+def qualified_field_name(field) -> str:
+    """Builds a field's fully qualified name the way pypdf does, honouring /TM."""
+    parts = []
+    seen = set()
+    while True:
+        field = field.get_object()
+        if id(field) in seen:
+            raise ValueError("Detected a cycle in the /Parent chain of a form field.")
+        seen.add(id(field))
+        if "/TM" in field:
+            parts.append(str(field["/TM"]))
+            break
+        parts.append(str(field.get("/T", "")))
+        if "/Parent" not in field:
+            break
+        field = field["/Parent"]
+    return ".".join(reversed(parts))
+
+
+def page_field_names(page) -> set[str]:
+    """Returns every name pypdf would match a value against for the widgets on a page."""
+    names = set()
+    for annot in page.get("/Annots") or []:
+        annot = annot.get_object()
+        if annot.get("/Subtype") != "/Widget":
+            continue
+        # Same rule as pypdf's update_page_form_field_values: a widget is its
+        # own field only when it carries both /FT and /T, else its /Parent is.
+        field = annot if "/FT" in annot and "/T" in annot else annot.get("/Parent")
+        if field is None:
+            continue
+        field = field.get_object()
+        if "/T" in field:
+            names.add(str(field["/T"]))
+        names.add(qualified_field_name(field))
+    return names
+
+
+def fill_pdf_bytes(pdf_bytes: bytes, digest: str, values: dict[str, str]) -> bytes:
     """Fills a PDF form with the given values across ALL pages."""
-    reader = PdfReader(io.BytesIO(pdf_bytes))
     writer = PdfWriter()
-    writer.append(reader)
+    reader, lock = get_reader(pdf_bytes, digest)
+    with lock:
+        writer.append(reader)
 
     for page in writer.pages:
+        # Only hand each page the values for fields it actually carries, so
+        # multi-page forms aren't matched as every field x every page.
         try:
-            writer.update_page_form_field_values(page, values)
+            names = page_field_names(page)
+            page_values = {k: v for k, v in values.items() if k in names}
+            if not page_values:
+                continue
+            writer.update_page_form_field_values(page, page_values)
         except Exception as e:
             log.warning(f"Could not fill some fields on a page: {e}")
 
-    try:
-        if writer.root_object and writer.root_object.get("/AcroForm"):
-            writer.root_object["/AcroForm"][NameObject("/NeedAppearances")] = BooleanObject(True)
-    except Exception as e:
-        log.warning(f"Could not set NeedAppearances flag: {e}")
+    acro_form = writer.root_object.get("/AcroForm")
+    if acro_form is not None:
+        acro_form.get_object()[NameObject("/NeedAppearances")] = BooleanObject(True)
 
     buf = io.BytesIO()
     writer.write(buf)
     return buf.getvalue()
 
+
+def fill_template(pdf_bytes: bytes, digest: str, values: dict[str, str]) -> bytes:
+    """Fills the PDF, reusing the earlier output if the same values were already applied."""
+    # pypdf field names can be TextStringObject, a str subclass that orjson
+    # only accepts as a dict key with OPT_NON_STR_KEYS.
+    payload = orjson.dumps([digest, values], option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    key = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    filled = _cache_get(_filled_pdfs, key)
+    if filled is None:
+        filled = fill_pdf_bytes(pdf_bytes, digest, values)
+        _cache_put(_filled_pdfs, key, filled)
+    return filled
+
+def read_pdf(pdf_path: str) -> bytes:
+    """Reads the PDF in one sized read and closes the handle straight away."""
+    with open(pdf_path, "rb", buffering=0) as f:
+        return f.readall()
+
+def save_pdf(output_path: str, pdf_bytes: bytes) -> None:
+    """Writes the PDF to disk, creating its directory if needed."""
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "wb") as f:
+        f.write(pdf_bytes)
+
 # ----- Core LLM-powered Logic ---------------------------------
 
-def map_fields_with_vision(pdf_bytes: bytes, fields: dict) -> dict:
+@functools.lru_cache(maxsize=4)
+def get_model(name: str = LLM_MODEL) -> genai.GenerativeModel:
+    """Returns a shared GenerativeModel instead of building one per call."""
+    return genai.GenerativeModel(name)
+
+
+def parse_llm_json(text: str) -> dict:
+    """Parses a JSON object reply from the LLM, ignoring anything around the object itself."""
+    match = _JSON_RE.search(text)
+    if match is None:
+        raise ValueError("No JSON object found in LLM response.")
+    result = orjson.loads(match.group(0))
+    if not isinstance(result, dict):
+        raise ValueError("LLM response is not a JSON object.")
+    return result
+
+
+def render_first_page(pdf_bytes: bytes, digest: str) -> bytes:
+    """Rasterizes the first page to JPEG, reusing a cached render of the same PDF."""
+    img_bytes = _cache_get(_page_images, digest)
+    if img_bytes is None:
+        image = convert_from_bytes(pdf_bytes, dpi=VISION_DPI, first_page=1, last_page=1)[0]
+        image.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.Resampling.LANCZOS)
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format='JPEG', quality=85, optimize=False, progressive=False)
+        img_bytes = img_byte_arr.getvalue()
+        _cache_put(_page_images, digest, img_bytes)
+    return img_bytes
+
+
+async def map_fields_with_vision(pdf_bytes: bytes, fields: dict, digest: str) -> dict:
     """Uses a vision model to map internal field names to human-readable labels."""
     log.info("Starting vision-based field mapping...")
     try:
-        image = convert_from_bytes(pdf_bytes, dpi=200, first_page=1, last_page=1)[0]
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_bytes = img_byte_arr.getvalue()
+        img_bytes = await asyncio.to_thread(render_first_page, pdf_bytes, digest)
     except Exception as e:
         log.error(f"Failed to convert PDF to image for vision analysis: {e}. Falling back to non-vision mode.")
         return {}
     
-    model = genai.GenerativeModel(LLM_MODEL)
+    model = get_model()
     field_ids = list(fields.keys())
 
     prompt = textwrap.dedent(f"""
@@ -108,9 +284,8 @@ def map_fields_with_vision(pdf_bytes: bytes, fields: dict) -> dict:
     """)
     
     try:
-        response = model.generate_content([prompt, {"mime_type": "image/png", "data": img_bytes}])
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
-        vision_mapping = json.loads(json_text)
+        response = await model.generate_content_async([prompt, {"mime_type": "image/jpeg", "data": img_bytes}])
+        vision_mapping = parse_llm_json(response.text)
         log.info(f"Vision model successfully mapped {len(vision_mapping)} fields.")
         return vision_mapping
     except Exception as e:
@@ -118,11 +293,41 @@ def map_fields_with_vision(pdf_bytes: bytes, fields: dict) -> dict:
         return {}
 
 
-def extract_answers_with_llm(human_readable_fields: list[str], context: str) -> dict:
+def build_field_mapping(text_fields: dict, vision_mapping: dict) -> dict[str, str]:
+    """Maps each human-readable label to the first internal field name carrying it."""
+    field_mapping = {}
+    for internal_name, field_obj in text_fields.items():
+        human_name = vision_mapping.get(internal_name)
+        if not human_name or not isinstance(human_name, str):
+            human_name = field_obj.get('/T')
+        if not human_name:
+            human_name = internal_name
+
+        if human_name not in field_mapping:
+            field_mapping[str(human_name)] = internal_name
+    return field_mapping
+
+
+async def get_field_mapping(pdf_bytes: bytes, text_fields: dict, digest: str) -> dict[str, str]:
+    """Returns the label mapping for this PDF, running the vision model only for new templates."""
+    field_mapping = _cache_get(_field_mappings, digest)
+    if field_mapping is not None:
+        log.info("Reusing cached field mapping for this PDF template.")
+        return field_mapping
+
+    vision_mapping = await map_fields_with_vision(pdf_bytes, text_fields, digest)
+    field_mapping = build_field_mapping(text_fields, vision_mapping)
+    # Don't pin a non-vision fallback; the next call should retry vision.
+    if vision_mapping:
+        _cache_put(_field_mappings, digest, field_mapping)
+    return field_mapping
+
+
+async def extract_answers_with_llm(human_readable_fields: list[str], context: str) -> dict:
     """
     Uses an LLM to find answers for fields, enhancing subjective answers.
     """
-    model = genai.GenerativeModel(LLM_MODEL)
+    model = get_model()
     field_list_str = ", ".join([f'"{field}"' for field in human_readable_fields])
 
     # This prompt is now enhanced to act as a career coach for subjective fields.
@@ -154,21 +359,42 @@ def extract_answers_with_llm(human_readable_fields: list[str], context: str) ->
 
     log.info(f"Sending {len(human_readable_fields)} human-readable fields to the LLM for extraction and enhancement.")
     try:
-        response = model.generate_content(prompt)
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
-        return json.loads(json_text)
+        response = await model.generate_content_async(prompt)
+        return parse_llm_json(response.text)
     except Exception as e:
         log.error(f"Failed to get or parse extraction response from LLM: {e}")
         return {field: "N/A" for field in human_readable_fields}
 
-def generate_detailed_question(missing_fields: list[str]) -> str:
+async def extract_all_answers(human_readable_fields: list[str], context: str) -> dict:
+    """Extracts answers for every field, fanning large forms out over concurrent LLM calls."""
+    if len(human_readable_fields) <= EXTRACTION_CHUNK_THRESHOLD:
+        return await extract_answers_with_llm(human_readable_fields, context)
+
+    chunks = [
+        human_readable_fields[i:i + EXTRACTION_CHUNK_SIZE]
+        for i in range(0, len(human_readable_fields), EXTRACTION_CHUNK_SIZE)
+    ]
+    log.info(f"Splitting {len(human_readable_fields)} fields into {len(chunks)} concurrent extraction calls.")
+
+    async def extract_chunk(chunk: list[str]) -> dict:
+        async with _extraction_slots:
+            return await extract_answers_with_llm(chunk, context)
+
+    results = await asyncio.gather(*(extract_chunk(chunk) for chunk in chunks))
+
+    answers = {}
+    for result in results:
+        answers.update(result)
+    return answers
+
+async def generate_detailed_question(missing_fields: list[str]) -> str:
     """Uses the LLM to generate a user-friendly question for a short list of missing info."""
-    model = genai.GenerativeModel(LLM_MODEL)
+    model = get_model()
     field_list = ", ".join(missing_fields)
     prompt = f"You are a friendly assistant. You couldn't find the following information: {field_list}. Formulate a single, polite question to ask the user for all of it."
     log.info(f"Asking LLM to generate a detailed clarifying question for: {missing_fields}")
     try:
-        response = model.generate_content(prompt)
+        response = await model.generate_content_async(prompt)
         return response.text.strip()
     except Exception as e:
         log.error(f"Failed to generate detailed question from LLM: {e}")
@@ -182,15 +408,15 @@ mcp = FastMCP(
 )
 
 @mcp.tool()
-def fill_form(pdf_path: str, context: str) -> dict:
+async def fill_form(pdf_path: str, context: str) -> dict:
     """The main tool function that orchestrates the PDF filling process."""
     if not os.path.isfile(pdf_path):
         return {"status": "error", "message": f"File not found: {pdf_path}"}
 
     try:
-        pdf_bytes = open(pdf_path, "rb").read()
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        fields = reader.get_fields() or {}
+        pdf_bytes = await asyncio.to_thread(read_pdf, pdf_path)
+        digest = pdf_digest(pdf_bytes)
+        fields = await asyncio.to_thread(read_form_fields, pdf_bytes, digest)
     except Exception as e:
         return {"status": "error", "message": f"Could not read PDF: {e}"}
 
@@ -201,36 +427,21 @@ def fill_form(pdf_path: str, context: str) -> dict:
     if not text_fields:
         return {"status": "error", "message": "No text fields detected."}
 
-    vision_mapping = map_fields_with_vision(pdf_bytes, text_fields)
-    
-    field_mapping = {}
-    for internal_name, field_obj in text_fields.items():
-        human_name = vision_mapping.get(internal_name)
-        if not human_name:
-            human_name = field_obj.get('/T')
-        if not human_name:
-            human_name = internal_name
-        
-        if human_name not in field_mapping:
-            field_mapping[human_name] = internal_name
-    
+    field_mapping = await get_field_mapping(pdf_bytes, text_fields, digest)
     human_readable_names = list(field_mapping.keys())
-    extracted_values_by_human_name = extract_answers_with_llm(human_readable_names, context)
+    extracted_values_by_human_name = await extract_all_answers(human_readable_names, context)
 
     values_for_pdf = {}
-    missing_human_names = []
+    missing_human_names = set()
     for human_name, internal_name in field_mapping.items():
-        if not isinstance(human_name, str):
-            continue
-            
         value = extracted_values_by_human_name.get(human_name, "N/A").strip()
         if value and value != "N/A":
             values_for_pdf[internal_name] = value
         else:
-            missing_human_names.append(human_name)
+            missing_human_names.add(human_name)
 
     if missing_human_names:
-        unique_missing = sorted(list(set(missing_human_names)))
+        unique_missing = sorted(missing_human_names)
         log.warning(f"Information is missing for the following fields: {unique_missing}")
 
         # If too many fields are missing, create a simple message with examples
@@ -242,24 +453,22 @@ def fill_form(pdf_path: str, context: str) -> dict:
             log.info("Too many fields missing. Generating a simple summary question to avoid timeout.")
         else:
             # If a manageable number are missing, ask the AI to formulate a friendly question.
-            question = generate_detailed_question(unique_missing)
+            question = await generate_detailed_question(unique_missing)
             
         return {"status": "need_info", "message": question}
 
     # --- Final PDF Generation and Saving ---
     log.info(f"Populating PDF with data: {values_for_pdf}")
     try:
-        pdf_filled_bytes = fill_pdf_bytes(pdf_bytes, values_for_pdf)
+        pdf_filled_bytes = await asyncio.to_thread(fill_template, pdf_bytes, digest, values_for_pdf)
         output_dir = "filled_pdfs"
-        os.makedirs(output_dir, exist_ok=True)
         filename = f"filled_{os.path.basename(pdf_path).replace('.pdf', '')}_{uuid.uuid4().hex[:6]}.pdf"
         output_path = os.path.join(output_dir, filename)
 
-        with open(output_path, "wb") as f:
-            f.write(pdf_filled_bytes)
+        await asyncio.to_thread(save_pdf, output_path, pdf_filled_bytes)
         log.info(f"Successfully saved filled PDF to: {output_path}")
 
-        encoded_pdf = base64.b64encode(pdf_filled_bytes).decode()
+        encoded_pdf = pybase64.b64encode(pdf_filled_bytes).decode("ascii")
         return {"status": "done", "filename": filename, "filled_pdf": encoded_pdf, "local_path": output_path}
     except Exception as e:
         log.error(f"Critical error during PDF generation: {e}")
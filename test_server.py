@@ -0,0 +1,159 @@
+import asyncio
+import io
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    FloatObject,
+    NameObject,
+    TextStringObject,
+)
+
+import server
+
+
+def add_widget(writer: PdfWriter, page, **entries) -> DictionaryObject:
+    """Adds a text widget annotation to the page and returns it."""
+    widget = DictionaryObject({
+        NameObject("/Type"): NameObject("/Annot"),
+        NameObject("/Subtype"): NameObject("/Widget"),
+        NameObject("/Rect"): ArrayObject([FloatObject(v) for v in (50, 700, 300, 720)]),
+    })
+    for key, value in entries.items():
+        widget[NameObject(f"/{key}")] = value
+    widget_ref = writer._add_object(widget)
+    page.setdefault(NameObject("/Annots"), ArrayObject()).append(widget_ref)
+    return widget
+
+
+def finish_form(writer: PdfWriter, fields: list) -> bytes:
+    """Attaches the AcroForm with the given top-level fields and serializes the PDF."""
+    writer.root_object[NameObject("/AcroForm")] = DictionaryObject({
+        NameObject("/Fields"): ArrayObject(field.indirect_reference for field in fields),
+        NameObject("/DA"): TextStringObject("/Helv 0 Tf 0 g"),
+    })
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def make_hierarchical_form() -> bytes:
+    """Builds a one-page form whose text field `addr` has a kid widget `street`
+    that carries its own /T but inherits /FT from the parent."""
+    writer = PdfWriter()
+    page = writer.add_blank_page(width=612, height=792)
+
+    parent = DictionaryObject({
+        NameObject("/FT"): NameObject("/Tx"),
+        NameObject("/T"): TextStringObject("addr"),
+    })
+    writer._add_object(parent)
+    widget = add_widget(writer, page, T=TextStringObject("street"), Parent=parent.indirect_reference)
+    parent[NameObject("/Kids")] = ArrayObject([widget.indirect_reference])
+    return finish_form(writer, [parent])
+
+
+def make_paged_form(pages: int, mapped: bool = False) -> bytes:
+    """Builds a form with one text field per page, named `field<N>`, and
+    optionally a `mapped<N>` /TM name that pypdf keys the field by."""
+    writer = PdfWriter()
+    fields = []
+    for i in range(pages):
+        page = writer.add_blank_page(width=612, height=792)
+        entries = {"FT": NameObject("/Tx"), "T": TextStringObject(f"field{i}")}
+        if mapped:
+            entries["TM"] = TextStringObject(f"mapped{i}")
+        fields.append(add_widget(writer, page, **entries))
+    return finish_form(writer, fields)
+
+
+def fill(pdf_bytes: bytes, values: dict[str, str]) -> dict:
+    """Fills the PDF through fill_pdf_bytes and returns the resulting field values."""
+    filled = server.fill_pdf_bytes(pdf_bytes, server.pdf_digest(pdf_bytes), values)
+    return {name: field.value for name, field in PdfReader(io.BytesIO(filled)).get_fields().items()}
+
+
+def test_page_field_names_uses_parent_of_widget_without_ft():
+    pdf_bytes = make_hierarchical_form()
+    page = PdfReader(io.BytesIO(pdf_bytes)).pages[0]
+
+    assert "addr" in server.page_field_names(page)
+
+
+def test_fill_pdf_bytes_fills_hierarchical_field():
+    assert fill(make_hierarchical_form(), {"addr": "X"})["addr"] == "X"
+
+
+def test_fill_pdf_bytes_fills_fields_keyed_by_mapping_name():
+    pdf_bytes = make_paged_form(3, mapped=True)
+    values = {f"mapped{i}": f"Xmapped{i}" for i in range(3)}
+
+    assert set(PdfReader(io.BytesIO(pdf_bytes)).get_fields()) == set(values)
+    assert fill(pdf_bytes, values) == values
+
+
+def test_fill_pdf_bytes_gives_each_page_only_its_own_fields(monkeypatch):
+    pdf_bytes = make_paged_form(3)
+    values = {f"field{i}": f"value{i}" for i in range(3)}
+    calls = []
+    update = PdfWriter.update_page_form_field_values
+
+    def record(self, page, fields, *args, **kwargs):
+        calls.append(dict(fields))
+        return update(self, page, fields, *args, **kwargs)
+
+    monkeypatch.setattr(PdfWriter, "update_page_form_field_values", record)
+
+    assert fill(pdf_bytes, values) == values
+    assert calls == [{"field0": "value0"}, {"field1": "value1"}, {"field2": "value2"}]
+
+
+def test_fill_pdf_bytes_skips_page_with_parent_cycle():
+    writer = PdfWriter()
+    page = writer.add_blank_page(width=612, height=792)
+    a = DictionaryObject({NameObject("/T"): TextStringObject("a")})
+    b = DictionaryObject({NameObject("/T"): TextStringObject("b")})
+    writer._add_object(a)
+    writer._add_object(b)
+    a[NameObject("/Parent")] = b.indirect_reference
+    b[NameObject("/Parent")] = a.indirect_reference
+    add_widget(writer, page, T=TextStringObject("w"), Parent=a.indirect_reference)
+    pdf_bytes = finish_form(writer, [a])
+
+    with pytest.raises(ValueError):
+        server.page_field_names(PdfReader(io.BytesIO(pdf_bytes)).pages[0])
+    server.fill_pdf_bytes(pdf_bytes, server.pdf_digest(pdf_bytes), {"a": "X"})
+
+
+def test_parse_llm_json_ignores_prose_and_fences():
+    text = 'Sure [note]: here you go\n```json\n{"a": 1}\n```'
+
+    assert server.parse_llm_json(text) == {"a": 1}
+
+
+def test_parse_llm_json_rejects_non_object_reply():
+    with pytest.raises(ValueError):
+        server.parse_llm_json('["a", "b"]')
+
+
+def test_extract_all_answers_bounds_concurrent_calls(monkeypatch):
+    fields = [f"field{i}" for i in range(200)]
+    in_flight = 0
+    peak = 0
+
+    async def fake_extract(chunk, context):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return {field: "x" for field in chunk}
+
+    monkeypatch.setattr(server, "extract_answers_with_llm", fake_extract)
+
+    answers = asyncio.run(server.extract_all_answers(fields, "context"))
+
+    assert answers == {field: "x" for field in fields}
+    assert peak == server.EXTRACTION_MAX_CONCURRENCY